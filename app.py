@@ -1,13 +1,85 @@
+import asyncio
 import io
+import re
+import shutil
+import tempfile
 import time
 import zipfile
-import json
+from contextlib import asynccontextmanager
+
+import httpx
+import orjson
 import pandas as pd
-import requests
+import pyarrow.csv as pacsv
 import streamlit as st
-from urllib.parse import urlparse, parse_qs
 
 API_ENDPOINT = "https://www.autonation.com/api/ebrochure?vid="
+HYPERLINK_RE = r'(?i)=HYPERLINK\("([^"]+)"'
+VID_RE = re.compile(r"[?&]VID=([^&#]+)", re.IGNORECASE)
+# Advertise brotli — ~20-30% smaller than gzip on HTML/JSON; httpx
+# decodes it transparently once the brotli package is installed
+DEFAULT_HEADERS = {"Accept-Encoding": "gzip, br"}
+API_CONCURRENCY = 50
+DOWNLOAD_CONCURRENCY = 10
+POOL_LIMIT = 50
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+async def get_with_retry(client, url, *, retries=3, backoff=1.5, **kwargs):
+    """GET with automatic retries on transient failures (exponential backoff)."""
+    for attempt in range(retries + 1):
+        try:
+            resp = await client.get(url, **kwargs)
+        except httpx.TransportError:
+            if attempt >= retries:
+                raise
+        else:
+            if resp.status_code not in RETRY_STATUSES or attempt >= retries:
+                return resp
+        await asyncio.sleep(backoff * (2 ** attempt))
+
+
+@asynccontextmanager
+async def stream_with_retry(client, url, *, retries=3, backoff=1.5, **kwargs):
+    """Streaming GET that retries opening the stream like get_with_retry.
+
+    Only establishing the stream is retried; errors raised while the caller
+    reads the body propagate unchanged (a generator must not yield again
+    after an exception is thrown in at the yield point).
+    """
+    for attempt in range(retries + 1):
+        try:
+            request = client.build_request("GET", url, **kwargs)
+            resp = await client.send(request, stream=True)
+        except httpx.TransportError:
+            if attempt >= retries:
+                raise
+        else:
+            if resp.status_code not in RETRY_STATUSES or attempt >= retries:
+                break
+            await resp.aclose()
+        await asyncio.sleep(backoff * (2 ** attempt))
+    try:
+        yield resp
+    finally:
+        await resp.aclose()
+
+
+@st.cache_resource(ttl=86400)
+def carfax_url_cache() -> dict:
+    """VID → Carfax URL lookups, shared across reruns and sessions for a day."""
+    return {}
+
+
+@st.cache_data
+def load_csv(file_bytes: bytes) -> pd.DataFrame:
+    """Parse the upload once; widget-only reruns hit the cache."""
+    table = pacsv.read_csv(
+        io.BytesIO(file_bytes),
+        read_options=pacsv.ReadOptions(use_threads=True)
+    )
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
 
 st.set_page_config(page_title="AutoNation Carfax Fetcher", layout="wide")
 st.title("🚗 AutoNation Carfax Fetcher (API-powered, No 403 Errors)")
@@ -18,7 +90,7 @@ st.write("Upload a CSV containing AutoNation eBrochure links. This tool extracts
 uploaded = st.file_uploader("Upload CSV", type=["csv"])
 
 if uploaded:
-    df = pd.read_csv(uploaded)
+    df = load_csv(uploaded.getvalue())
 
     st.subheader("CSV Preview")
     st.dataframe(df.head())
@@ -31,130 +103,218 @@ if uploaded:
                 return col
         return df.columns[0]
 
-    ebrochure_col = st.selectbox(
-        "Select column containing eBrochure URLs",
-        df.columns,
-        index=list(df.columns).index(guess_col(["ebrochure", "vlp", "brochure"]))
-    )
+    # The form batches widget changes into one rerun, so tweaking the
+    # selections never re-triggers work until Start is pressed
+    with st.form("scrape"):
+        ebrochure_col = st.selectbox(
+            "Select column containing eBrochure URLs",
+            df.columns,
+            index=list(df.columns).index(guess_col(["ebrochure", "vlp", "brochure"]))
+        )
 
-    vin_col = st.selectbox(
-        "Select VIN column (used for filenames)",
-        df.columns,
-        index=list(df.columns).index(guess_col(["vin"]))
-    )
+        vin_col = st.selectbox(
+            "Select VIN column (used for filenames)",
+            df.columns,
+            index=list(df.columns).index(guess_col(["vin"]))
+        )
 
-    download_files = st.checkbox("Download Carfax PDF/HTML files", value=True)
+        download_files = st.checkbox("Download Carfax PDF/HTML files", value=True)
 
-    go = st.button("Start")
+        go = st.form_submit_button("Start")
 
     if go:
-        results = []
-        carfax_files = {}
-        session = requests.Session()
-        total = len(df)
         progress = st.progress(0)
         status = st.empty()
-
-        for i, row in df.iterrows():
-            progress.progress((i + 1) / total)
-
-            e_url = str(row[ebrochure_col]).strip()
-            vin = str(row[vin_col]).strip()
-
-            status.text(f"[{i+1}/{total}] Processing VIN {vin}…")
-
+        state = {"done": 0, "files_written": 0, "last_update": 0.0}
+
+        # Spill the ZIP to disk past 64 MB so downloads never accumulate in RAM
+        zip_tmp = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+        zip_file = zipfile.ZipFile(zip_tmp, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+        zip_lock = asyncio.Lock()
+        url_cache = carfax_url_cache()
+
+        # Normalize URLs in one vectorized pass: strip whitespace/quotes,
+        # unwrap Excel =HYPERLINK() formulas, prefix scheme-less hosts
+        urls = df[ebrochure_col].astype("string").str.strip().str.strip("'\"")
+        # Only Excel-exported CSVs contain =HYPERLINK() formulas, so run
+        # the extraction regex on just the rows that start with "="
+        formula = urls.str.startswith("=", na=False)
+        if formula.any():
+            extracted = urls[formula].str.extract(HYPERLINK_RE, expand=False)
+            urls = urls.mask(formula, extracted.fillna(urls[formula]))
+        urls = urls.where(~urls.str.startswith("www.", na=False), "https://" + urls)
+        urls = urls.fillna("").astype(str)
+        vins = df[vin_col].astype(str).str.strip()
+
+        # Merged exports often repeat rows — fetch each distinct URL once
+        # and let duplicate rows share the result
+        uniq_urls = urls.drop_duplicates()
+        first_vin = {}
+        for u, v in zip(urls, vins):
+            first_vin.setdefault(u, v)
+        total = len(uniq_urls)
+        downloaded_files = {}
+
+        def tick(label, phase_total):
+            state["done"] += 1
+            # Each progress/status call pushes a websocket frame to the
+            # browser, so throttle UI updates to ~2/s
+            now = time.monotonic()
+            if now - state["last_update"] > 0.5 or state["done"] == phase_total:
+                progress.progress(state["done"] / phase_total)
+                status.text(f"[{state['done']}/{phase_total}] {label}")
+                state["last_update"] = now
+
+        async def lookup_row(client, sem, vin, e_url):
             # Extract VID from URL
-            try:
-                parsed = urlparse(e_url)
-                vid = parse_qs(parsed.query).get("VID", [None])[0]
-            except:
-                vid = None
-
-            if not vid:
-                results.append({
-                    "VIN": vin,
-                    "EBROCHURE_URL": e_url,
-                    "VID": None,
-                    "CARFAX_URL": None,
-                    "STATUS": "NO_VID"
-                })
-                continue
-
-            # Call hidden API endpoint
-            api_url = API_ENDPOINT + vid
-            carfax_url = None
-            file_name = None
-            status_label = ""
-
-            try:
-                resp = session.get(api_url, timeout=20)
-                data = resp.json()
-                carfax_url = data.get("carfaxUrl")
-
-                if not carfax_url:
-                    status_label = "NO_CARFAX_FOUND"
-                else:
-                    status_label = "FOUND_URL"
-
-                    if download_files:
-                        try:
-                            r2 = session.get(carfax_url, timeout=30)
+            m = VID_RE.search(e_url)
+            vid = m.group(1) if m else None
 
+            result = {
+                "_VIN": vin,
+                "VID": vid,
+                "CARFAX_URL": None,
+                "STATUS": "NO_VID",
+                "FILE_NAME": None
+            }
+
+            if vid:
+                async with sem:
+                    try:
+                        if vid in url_cache:
+                            carfax_url = url_cache[vid]
+                        else:
+                            # Call hidden API endpoint
+                            resp = await get_with_retry(client, API_ENDPOINT + vid)
+                            # orjson parses the raw bytes directly — no
+                            # charset sniff + str decode like resp.json()
+                            data = orjson.loads(resp.content)
+                            carfax_url = data.get("carfaxUrl")
+                            url_cache[vid] = carfax_url
+                        result["CARFAX_URL"] = carfax_url
+                        result["STATUS"] = "FOUND_URL" if carfax_url else "NO_CARFAX_FOUND"
+
+                    except Exception as e:
+                        result["STATUS"] = f"API_ERROR: {e}"
+
+            tick(f"Looked up VIN {vin}…", total)
+            return result
+
+        async def download_row(client, sem, result, phase_total):
+            vin = result["_VIN"]
+            carfax_url = result["CARFAX_URL"]
+
+            async with sem:
+                if carfax_url in downloaded_files:
+                    # Same report already written for another VIN
+                    result["FILE_NAME"] = downloaded_files[carfax_url]
+                    result["STATUS"] = "DOWNLOADED"
+                else:
+                    try:
+                        async with stream_with_retry(
+                            client, carfax_url, timeout=30.0
+                        ) as r2:
+                            r2.raise_for_status()
                             content_type = r2.headers.get("Content-Type", "").lower()
                             ext = ".pdf" if "pdf" in content_type else ".html"
-
                             file_name = f"{vin}{ext}"
-                            carfax_files[file_name] = r2.content
-                            status_label = "DOWNLOADED"
-
-                        except Exception as e:
-                            status_label = f"URL_ONLY ({e})"
-
-            except Exception as e:
-                status_label = f"API_ERROR: {e}"
 
-            results.append({
-                "VIN": vin,
-                "EBROCHURE_URL": e_url,
-                "VID": vid,
-                "CARFAX_URL": carfax_url,
-                "STATUS": status_label,
-                "FILE_NAME": file_name
-            })
-
-            time.sleep(0.1)
-
-        results_df = pd.DataFrame(results)
+                            # PDFs are already flate-compressed; deflating
+                            # them again just burns CPU
+                            zinfo = zipfile.ZipInfo(file_name)
+                            zinfo.compress_type = (
+                                zipfile.ZIP_STORED if ext == ".pdf" else zipfile.ZIP_DEFLATED
+                            )
+
+                            # Buffer the body before touching the archive — a
+                            # mid-stream failure must not finalize a truncated
+                            # member (zipfile can't remove entries)
+                            with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as body:
+                                async for chunk in r2.aiter_bytes(65536):
+                                    body.write(chunk)
+                                body.seek(0)
+                                # Lock only the local copy into the ZIP so
+                                # bodies keep downloading concurrently
+                                async with zip_lock:
+                                    with zip_file.open(zinfo, "w", force_zip64=True) as dest:
+                                        shutil.copyfileobj(body, dest, 65536)
+
+                        result["FILE_NAME"] = file_name
+                        result["STATUS"] = "DOWNLOADED"
+                        downloaded_files[carfax_url] = file_name
+                        state["files_written"] += 1
+
+                    except Exception as e:
+                        result["STATUS"] = f"URL_ONLY ({e})"
+
+            tick(f"Downloaded report for VIN {vin}…", phase_total)
+
+        async def run_all():
+            limits = httpx.Limits(
+                max_connections=POOL_LIMIT,
+                max_keepalive_connections=POOL_LIMIT
+            )
+            async with httpx.AsyncClient(
+                http2=True, limits=limits, headers=DEFAULT_HEADERS,
+                timeout=20.0, follow_redirects=True
+            ) as client:
+                # Phase 1: resolve every Carfax URL (all autonation.com, so
+                # the whole wave rides the same keep-alive connections)
+                api_sem = asyncio.Semaphore(API_CONCURRENCY)
+                results = await asyncio.gather(*(
+                    lookup_row(client, api_sem, first_vin[url], url)
+                    for url in uniq_urls
+                ))
+
+                # Phase 2: download the reports (all carfax.com)
+                if download_files:
+                    pending = [r for r in results if r["CARFAX_URL"]]
+                    if pending:
+                        state["done"] = 0
+                        dl_sem = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+                        await asyncio.gather(*(
+                            download_row(client, dl_sem, r, len(pending))
+                            for r in pending
+                        ))
+
+                return results
+
+        results = asyncio.run(run_all())
+        zip_file.close()
+
+        # Expand per-URL results back onto the full row set, one column at
+        # a time — no per-row dicts for pandas to transpose and re-infer
+        url_result = dict(zip(uniq_urls, results))
+        results_df = pd.DataFrame({"VIN": vins, "EBROCHURE_URL": urls})
+        for field in ("VID", "CARFAX_URL", "STATUS", "FILE_NAME"):
+            results_df[field] = urls.map(
+                {url: res[field] for url, res in url_result.items()}
+            )
 
         st.subheader("Results")
         st.dataframe(results_df)
 
         # Attach CARFAX_URL to original CSV
-        merged = df.copy()
         lut = results_df.set_index("VIN")["CARFAX_URL"].to_dict()
-        merged["CARFAX_URL"] = merged[vin_col].astype(str).map(lut)
+        df["CARFAX_URL"] = df[vin_col].astype(str).map(lut)
 
-        csv_buf = io.StringIO()
-        merged.to_csv(csv_buf, index=False)
+        csv_buf = io.BytesIO()
+        df.to_csv(csv_buf, index=False, encoding="utf-8")
+        csv_buf.seek(0)
 
         st.download_button(
             "⬇️ Download CSV with CARFAX_URL",
-            csv_buf.getvalue().encode(),
+            csv_buf,
             "listings_with_carfax.csv",
             "text/csv"
         )
 
         # ZIP of Carfax files
-        if download_files and carfax_files:
-            zip_buf = io.BytesIO()
-            with zipfile.ZipFile(zip_buf, "w") as zipf:
-                for fname, content in carfax_files.items():
-                    zipf.writestr(fname, content)
-
-            zip_buf.seek(0)
+        if download_files and state["files_written"]:
+            zip_tmp.seek(0)
             st.download_button(
-                f"⬇️ Download ZIP of {len(carfax_files)} Carfax files",
-                zip_buf,
+                f"⬇️ Download ZIP of {state['files_written']} Carfax files",
+                zip_tmp,
                 "carfax_reports.zip",
                 "application/zip"
             )